@@ -18,25 +18,44 @@
 '''
 
 # third party imports
-from pandas import read_csv
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import train_test_split
+from pandas import read_csv, qcut
+import numpy as np
 
 # META DATA
 FILE_PATH = './segue.csv'
 Y_COL_NAME = 'feh'
 TEST_RATIO = 0.2
+NUM_BINS = 10           # number of metallicity quantile bins to stratify over
 
 if __name__ == '__main__':
     df = read_csv(FILE_PATH)
-    X = df.drop(Y_COL_NAME, axis=1)         # separate x and y values
-    Y = df[Y_COL_NAME]
 
-    x1, x2, y1, y2 = train_test_split(X, Y, test_size=TEST_RATIO)
+    # rows without a metallicity cannot be binned (nor trained on)
+    missing = df[Y_COL_NAME].isna().sum()
+    if missing:
+        print('Dropping %d rows without a %s value' % (missing, Y_COL_NAME))
+        df = df.dropna(subset=[Y_COL_NAME]).reset_index(drop=True)
 
-    # recombine with appropriate pairs to produce final datasets
-    x1[Y_COL_NAME] = y1
-    x2[Y_COL_NAME] = y2
+    # bucket row indices by metallicity bin in one pass (stable sort keeps the buckets contiguous)
+    y_bins = qcut(df[Y_COL_NAME], q=NUM_BINS, labels=False, duplicates='drop').to_numpy()
+    counts = np.bincount(y_bins)
+    class_indices = np.split(np.argsort(y_bins, kind='stable'), np.cumsum(counts)[:-1])
 
-    x1.to_csv('./train/data.csv', index=False)
-    x2.to_csv('./valid/data.csv', index=False)
+    # train size is fixed from the total, then shared out over the buckets through cumulative cuts
+    cuts = np.diff((np.cumsum(counts) * (1 - TEST_RATIO)).astype(int), prepend=0)
+
+    # shuffle each bucket and split it with the same ratio
+    train_idx = list()
+    valid_idx = list()
+
+    for bucket, cut in zip(class_indices, cuts):
+        np.random.shuffle(bucket)
+        train_idx.append(bucket[:cut])
+        valid_idx.append(bucket[cut:])
+
+    # shuffle row indices only -> the dataframe is sliced once per dataset
+    train_idx = np.random.permutation(np.concatenate(train_idx))
+    valid_idx = np.random.permutation(np.concatenate(valid_idx))
+
+    df.iloc[train_idx].to_csv('./train/data.csv', index=False)
+    df.iloc[valid_idx].to_csv('./valid/data.csv', index=False)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+'''
+    Photometric Approximator of Stellar Metallicity (c) by Rik Ghosh, Soham Saha
+
+    Photometric Approximator of Stellar Metallicity is licensed under a
+    Creative Commons Attribution 4.0 International License.
+
+    You should have received a copy of the license along with this work.
+    If not, see https://creativecommons.org/licenses/by/4.0
+'''
+
+'''
+    This python script contains the compiled (numba) kernel used by the preprocessing to find
+    the rows of the color matrix that lie inside the outlier thresholds. It is only imported by
+    preprocess.py for matrices large enough to repay loading numba and compiling the kernel
+
+    This file should not need any further editing from the side of the user
+'''
+
+# imports
+import numpy as np
+from numba import njit, prange
+
+
+# compiled implementation -> single fused pass over the rows, split across all cores
+@njit(parallel=True, cache=True)
+def outlier_mask(M, lo, hi):
+    '''
+    Finds the rows of a matrix whose values all lie inside [lo, hi]
+
+    Args:
+        M (numpy.ndarray): 2D color matrix with one column per color
+        lo (float)       : lower threshold
+        hi (float)       : upper threshold
+
+    Returns:
+        numpy.ndarray: boolean mask of the rows to keep
+    '''
+
+    n, m = M.shape
+    out = np.empty(n, np.bool_)
+
+    for i in prange(n):
+        keep = True
+        for j in range(m):
+            if not (M[i, j] >= lo and M[i, j] <= hi):       # NaN values are never kept
+                keep = False
+                break
+        out[i] = keep
+
+    return out
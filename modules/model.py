@@ -18,31 +18,184 @@
 '''
 
 # standard library imports
+import importlib.util
+import warnings
+import hashlib
+import copy
+import weakref
 import os
 
 # imports
 import sklearn.ensemble as en
-from copy import deepcopy
+import sklearn.metrics as mt
 import typing as tp
 import pandas as pd
 import numpy as np
-import pickle
+import joblib
 
 # custom library imports
-from preprocess import remove_outliers
+from preprocess import remove_outliers, outlier_bounds, outlier_mask, COLORS
 from visualize import truth_pred_scat, truth_pred_side
 
 # META DATA
-default_savename = 'model.sav'
+default_savename = 'model.joblib'
+legacy_savename = 'model.sav'           # default name used before models were saved with joblib
+_CURR_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))      # project root directory
+
+# training arguments that change the fitted model -> used to identify cached models
+_MODEL_KEYS = ('model', 'n_estimators', 'random_state', 'iqr_factor', 'num_reps', 'chunksize')
+
+# supported regressors and their default number of estimators (trees or boosting iterations)
+Regressor = tp.Union[en.RandomForestRegressor, en.HistGradientBoostingRegressor]
+_MODEL_TYPES = (en.RandomForestRegressor, en.HistGradientBoostingRegressor)
+_DEFAULT_ESTIMATORS = {'rf': 10, 'hgb': 200}
+
+# models already loaded in this process -> save path: (file modification time, model)
+_MODEL_CACHE = dict()
+_MODEL_CACHE_SIZE = 2                   # most recently loaded models kept alive, older ones are released
+
+# models compiled with treelite in this process -> model: predictor (entries vanish with their model)
+_PREDICTOR_CACHE = weakref.WeakKeyDictionary()
+
+# column types of the train and valid datasets (photometric colors -> float32 like the tree features,
+# metallicity stays float64 since scikit-learn fits the targets in double precision)
+_CSV_DTYPES = {'ug': 'float32', 'gr': 'float32', 'ri': 'float32', 'iz': 'float32', 'feh': 'float64'}
+
+# csv parser settings -> multithreaded pyarrow parser when available
+_CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') is not None else 'c'
+_CSV_KWARGS = dict(engine=_CSV_ENGINE, dtype=_CSV_DTYPES)
+
+
+# data loading utility function
+def _load_frame(path: str) -> pd.DataFrame:
+    '''
+    Loads a dataset, preferring an up-to-date parquet cache stored next to the csv file. The cache
+    is (re)written whenever it is missing or older than the csv file
+
+    Args:
+        path (str): path to the csv file
+
+    Returns:
+        pandas.DataFrame: the contents of the dataset
+    '''
+
+    cache_path = os.path.splitext(path)[0] + '.parquet'
+
+    if os.path.exists(cache_path) and os.path.getmtime(path) <= os.path.getmtime(cache_path):
+        return pd.read_parquet(cache_path)
+
+    df = pd.read_csv(path, **_CSV_KWARGS)
+
+    # write to a temporary file first -> an interrupted write never leaves a truncated cache behind
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+
+    try:
+        df.to_parquet(tmp_path, compression='zstd', index=False)
+        os.replace(tmp_path, cache_path)
+    except (ImportError, OSError):
+        # no parquet engine installed or data directory not writable -> skip caching
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return df
+
+
+# out-of-core training function
+def _train_chunked(path: str, args: dict) -> en.RandomForestRegressor:
+    '''
+    Trains a random forest on a csv file that is read in chunks. The peak memory usage is bound by the
+    larger of the chunk size and the number of rows per tree (rows / n_estimators, up to 1.5 times that
+    for the last group), so n_estimators has to grow with the file size. The first pass estimates
+    the outlier thresholds from a uniform random sample of the colors, the second pass filters the
+    chunks and grows the forest (warm start) on consecutive groups of rows, each group receiving a
+    share of the n_estimators trees proportional to its number of rows
+
+    Args:
+        path (str) : path to the csv file
+        args (dict): training arguments (see train())
+
+    Returns:
+        sklearn.ensemble.RandomForestRegressor: the trained model
+    '''
+
+    rng = np.random.default_rng(args['random_state'])
+    sample = np.empty((0, len(COLORS)), dtype=np.float32)
+    keys = np.empty(0)
+    n_rows = 0
+
+    # pass 1 -> reservoir sample (rows with the smallest random keys) of the color matrix
+    for chunk in pd.read_csv(path, chunksize=args['chunksize'], dtype=_CSV_DTYPES):
+        sample = np.concatenate((sample, chunk[COLORS].to_numpy(dtype=np.float32)))
+        keys = np.concatenate((keys, rng.random(len(chunk))))
+
+        if len(keys) > args['sample_size']:
+            keep = np.argpartition(keys, args['sample_size'])[:args['sample_size']]
+            sample = sample[keep]
+            keys = keys[keep]
+
+        n_rows += len(chunk)
+
+    if n_rows == 0:
+        raise ValueError('The file specified contains no data')
+
+    min_est, max_est = outlier_bounds(sample, args['iqr_factor'], args['num_reps'])
+
+    model = en.RandomForestRegressor(random_state=args['random_state'], n_jobs=args['n_jobs'], warm_start=True)
+    rows_per_tree = n_rows / args['n_estimators']
+
+    if rows_per_tree > 4 * args['chunksize']:
+        warnings.warn('every tree is fitted on about %d rows, which are held in memory at once (chunksize %d); '
+                      'raise n_estimators to lower the memory usage' % (rows_per_tree, args['chunksize']))
+
+    # grows the forest to n_trees trees, the new trees are fitted on the given rows only
+    def grow(x_parts: list, y_parts: list, n_trees: int) -> None:
+        model.set_params(n_estimators=n_trees)
+
+        with joblib.parallel_backend('threading'):
+            model.fit(np.concatenate(x_parts), np.concatenate(y_parts))
+
+    x_parts, y_parts = list(), list()       # rows of the group being collected
+    n_seen = 0
+    n_trees = 0
+
+    # pass 2 -> a group is fitted as soon as its rows earn at least one more tree
+    for chunk in pd.read_csv(path, chunksize=args['chunksize'], dtype=_CSV_DTYPES):
+        M = np.ascontiguousarray(chunk[COLORS].to_numpy(dtype=np.float32))
+        keep = outlier_mask(M, float(min_est), float(max_est))
+
+        x_parts.append(M[keep])
+        y_parts.append(chunk['feh'].to_numpy(dtype=np.float64)[keep])
+        n_seen += len(chunk)
+
+        target = args['n_estimators'] * n_seen // n_rows
+        if target == n_trees or sum(len(y) for y in y_parts) == 0:
+            continue                        # not enough rows for a new tree yet (or all were outliers)
+
+        if 0 < n_rows - n_seen < rows_per_tree / 2:
+            continue                        # rest of the file too short for its own trees -> part of this group
+
+        grow(x_parts, y_parts, target)
+        x_parts, y_parts = list(), list()
+        n_trees = target
+
+    if n_trees == 0:
+        raise ValueError('No rows of the file specified are left after removing the outliers')
+
+    # rows at the end of the file that were all outliers -> the forest keeps the n_trees trees grown so far
+    return model
+
 
 # saving utility function
-def save_model(curr_dir: str, model: en.RandomForestRegressor) -> None:
+def save_model(curr_dir: str, model: Regressor, savename: str = default_savename, compress: int = 3) -> None:
     '''
-    Saves the model so that it can be loaded in when required without needing training again
+    Saves the model so that it can be loaded in when required without needing training again. The tree
+    arrays are stored by joblib as compressed binary chunks
     
     Args:
-        curr_dir (str)                  : name of the current directory
-        model (en.RandomForestRegressor): the model to save
+        curr_dir (str)   : name of the current directory
+        model (Regressor): the model to save
+        savename (str)   : name of the saved model file
+        compress (int)   : zlib compression level (0 - 9), 0 disables compression
         
     Returns:
         None
@@ -50,26 +203,28 @@ def save_model(curr_dir: str, model: en.RandomForestRegressor) -> None:
 
     save_dir = os.path.join(curr_dir, 'models')             # directory for models
 
-    if not os.path.exists(save_dir):                        # check to see if the directory already exists
-        os.mkdir(save_dir)
+    os.makedirs(save_dir, exist_ok=True)                    # create the directory if it does not exist yet
 
-    save_path = os.path.join(save_dir, default_savename)
-    pickle.dump(model, open(save_path, 'wb'))
+    save_path = os.path.join(save_dir, savename)
+    joblib.dump(model, save_path, compress=compress)
 
-    print('Saved model in models/%s' % default_savename)
+    print('Saved model in models/%s' % savename)
 
 
 # loading utility function
-def load_model(curr_dir: str, savename: str) -> en.RandomForestRegressor:
+def load_model(curr_dir: str, savename: str) -> Regressor:
     '''
-    Loads a saved model so that it can be used
+    Loads a saved model so that it can be used. Legacy pickled models (.sav) are still supported, and
+    the legacy model.sav is used when the default model.joblib does not exist. Each model file is only
+    read once per process unless it is modified on disk, so the returned model is shared between calls:
+    copy it (copy.copy) before changing its parameters
     
     Args:
         curr_dir (str): name of the current directory
         savename (str): name of the saved model file
     
     Returns:
-        sklearn.ensemble.RandomForestRegressor: the saved model
+        Regressor: the saved model
     '''
     
     save_dir = os.path.join(curr_dir, 'models')             # directory for models
@@ -77,27 +232,97 @@ def load_model(curr_dir: str, savename: str) -> en.RandomForestRegressor:
         raise FileNotFoundError('There is no such directory called ./models')
 
     save_path = os.path.join(save_dir, savename)
-    model = pickle.load(open(save_path, 'rb'))
+
+    legacy_path = os.path.join(save_dir, legacy_savename)
+    if savename == default_savename and not os.path.exists(save_path) and os.path.exists(legacy_path):
+        # fall back to a model saved by an earlier version
+        save_path = legacy_path
+
+    mtime = os.path.getmtime(save_path)
+
+    if save_path in _MODEL_CACHE and _MODEL_CACHE[save_path][0] == mtime:
+        return _MODEL_CACHE[save_path][1]
+
+    model = joblib.load(save_path)                          # also reads plain pickle files
+
+    _MODEL_CACHE.pop(save_path, None)
+    _MODEL_CACHE[save_path] = (mtime, model)
+
+    while len(_MODEL_CACHE) > _MODEL_CACHE_SIZE:
+        del _MODEL_CACHE[next(iter(_MODEL_CACHE))]           # oldest entry first
 
     return model
 
 
+# prediction utility function
+def _predict(curr_dir: str, model: Regressor, x: np.ndarray, runtime: str = 'sklearn') -> np.ndarray:
+    '''
+    Predicts metallicity values with the chosen inference runtime. The 'treelite' runtime compiles the
+    tree ensemble into a native library (requires treelite, tl2cgen and a C compiler) and evaluates
+    batches of samples in compiled code. Compiled libraries are kept in ./models/treelite, so every
+    model is only compiled once
+
+    Args:
+        curr_dir (str)   : name of the current directory
+        model (Regressor): the model to predict with
+        x (numpy.ndarray): float32 input matrix with one column per color (in the order of COLORS)
+        runtime (str)    : 'sklearn' or 'treelite'
+
+    Returns:
+        numpy.ndarray: the predicted metallicity values
+    '''
+
+    if runtime == 'sklearn':
+        if hasattr(model, 'feature_names_in_'):
+            # legacy model fitted on a dataframe -> keep the column names so they are still validated
+            return model.predict(pd.DataFrame(x, columns=COLORS))
+
+        return model.predict(x)
+
+    if runtime != 'treelite':
+        raise ValueError('unknown runtime: %s' % runtime)
+
+    import treelite
+    import tl2cgen
+
+    if model not in _PREDICTOR_CACHE:
+        # name the library after the fitted state only -> changing n_jobs does not trigger a recompile
+        state = {k: v for k, v in vars(model).items() if k != 'n_jobs'}
+
+        lib_dir = os.path.join(curr_dir, 'models', 'treelite')
+        os.makedirs(lib_dir, exist_ok=True)
+        libpath = os.path.join(lib_dir, '%s.so' % joblib.hash((type(model).__name__, state)))
+
+        if not os.path.exists(libpath):
+            tl2cgen.export_lib(treelite.sklearn.import_model(model), toolchain='gcc', libpath=libpath,
+                               params={'parallel_comp': 32})
+
+        _PREDICTOR_CACHE[model] = tl2cgen.Predictor(libpath)
+
+    return _PREDICTOR_CACHE[model].predict(tl2cgen.DMatrix(x)).reshape(-1)
+
+
 # main training function
-def train(data_dir: str, args: dict = {}) -> en.RandomForestRegressor:
+def train(data_dir: str, args: dict = {}) -> Regressor:
     '''
-    Creates and trains the random forest regressor model using data from the specified path
+    Creates and trains the regressor model using data from the specified path. The model is either a
+    random forest ('rf') or a histogram-based gradient boosting regressor ('hgb'). With 'use_cache', a
+    model previously trained on the same (unmodified) file with the same arguments is loaded from the
+    cache in ./models instead of being fitted again (unless figures are requested with 'show' or 'save')
     
     Args:
         data_dir (str): path to the data source to train on
         args (dict)   : customizable method arguments passed in as a dictionary
     
     Returns:
-        sklearn.ensemble.RandomForestRegressor: the trained model
+        Regressor: the trained model
     '''
 
     _args = {
-        'n_estimators': 10,
+        'model'       : 'rf',
+        'n_estimators': None,
         'random_state': 0,
+        'n_jobs'      : -1,
         'iqr_factor'  : 1.5,
         'filename'    : '',
         'num_reps'    : 1,
@@ -105,6 +330,11 @@ def train(data_dir: str, args: dict = {}) -> en.RandomForestRegressor:
         'colors'      : [],
         'save'        : False,
         'save_model'  : False,
+        'compress'    : 3,
+        'use_cache'   : False,          # reuse / store fitted models in ./models/model.<key>.joblib
+        'chunksize'   : None,           # rows per chunk -> stream the file instead of loading it at once, memory is
+                                        # bound by max(chunksize, rows / n_estimators): raise n_estimators for big files
+        'sample_size' : 100000,         # rows sampled to find the outlier thresholds when streaming
         'dpi'         : 300
     }
 
@@ -115,41 +345,80 @@ def train(data_dir: str, args: dict = {}) -> en.RandomForestRegressor:
         # try default filename
         _args['filename'] = 'data.csv'
 
+    if _args['model'] not in _DEFAULT_ESTIMATORS:
+        raise ValueError('unknown model type: %s' % _args['model'])
+
+    if _args['n_estimators'] is None:
+        # use default number of estimators for the model type
+        _args['n_estimators'] = _DEFAULT_ESTIMATORS[_args['model']]
+
+    if _args['chunksize'] and _args['model'] != 'rf':
+        raise ValueError('chunked training is only supported for the random forest model')
+
     # find data directory
-    curr_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
-    target_file = os.path.join(curr_dir, data_dir, 'train', _args['filename'])
+    target_file = os.path.join(_CURR_DIR, data_dir, 'train', _args['filename'])
 
     if not os.path.exists(target_file):
         raise FileNotFoundError('The file specified does not exist')
-    
-    df = pd.read_csv(target_file)
 
-    # pre-processing
-    df = remove_outliers(df, _args)
+    # identify the model by its training arguments and the state of the data file
+    model_keys = _MODEL_KEYS + ('sample_size',) if _args['chunksize'] else _MODEL_KEYS
+    key = repr(sorted((k, _args[k]) for k in model_keys)) + target_file + str(os.path.getmtime(target_file))
+    cache_name = 'model.%s.joblib' % hashlib.sha1(key.encode()).hexdigest()[:12]
 
-    # split parameters from truth values
-    y = pd.DataFrame(df.pop('feh'))
-    x = df
+    # figures are only produced by the pre-processing -> never skip it when they are requested
+    use_cached = _args['use_cache'] and not (_args['show'] or _args['save'])
+
+    if use_cached and os.path.exists(os.path.join(_CURR_DIR, 'models', cache_name)):
+        model = load_model(_CURR_DIR, cache_name)
+        if _args['model'] == 'rf':
+            model = copy.copy(model)        # shallow copy shares the trees, the cached instance stays untouched
+            model.set_params(n_jobs=_args['n_jobs'])
+    elif _args['chunksize']:
+        model = _train_chunked(target_file, _args)
+
+        if _args['use_cache']:
+            save_model(_CURR_DIR, model, cache_name, _args['compress'])
+    else:
+        df = _load_frame(target_file)
+
+        # pre-processing
+        df = remove_outliers(df, _args)
 
-    # model creation
-    model = en.RandomForestRegressor(n_estimators=_args['n_estimators'], random_state=_args['random_state'])
-    model.fit(x, y.values.ravel())
+        # split parameters from truth values -> contiguous float32 features (no conversion copy inside the tree
+        # builder) and float64 targets (the dtype scikit-learn fits them in)
+        y_arr = df['feh'].to_numpy(dtype=np.float64, copy=False)
+        x_arr = np.ascontiguousarray(df[COLORS].to_numpy(dtype=np.float32, copy=False))
+
+        # model creation
+        if _args['model'] == 'hgb':
+            model = en.HistGradientBoostingRegressor(max_iter=_args['n_estimators'], random_state=_args['random_state'],
+                                                     early_stopping=True)
+        else:
+            model = en.RandomForestRegressor(n_estimators=_args['n_estimators'], random_state=_args['random_state'],
+                                             n_jobs=_args['n_jobs'])
+
+        with joblib.parallel_backend('threading'):     # trees are built in threads -> no process start-up cost
+            model.fit(x_arr, y_arr)
+
+        if _args['use_cache']:
+            save_model(_CURR_DIR, model, cache_name, _args['compress'])
 
     if _args['save_model']:
-        save_model(curr_dir, model)
+        save_model(_CURR_DIR, model, compress=_args['compress'])
 
     return model
 
 
 # scoring and evaluating function
-def score_eval(model: tp.Union[en.RandomForestRegressor, str], args: dict = {}) -> None:
+def score_eval(model: tp.Union[Regressor, str], args: dict = {}) -> None:
     '''
     Scores the accuracy of the trained model and provides evaluation metrics for the tested data
 
     Args:
-        model (en.RandomForestRegressor | str) : the model to evaluate itself, or 'load' indicating
-                                                 the model needs to be loaded in
-        args (dict)                            : customizable method arguments passed in as a dictionary
+        model (Regressor | str): the model to evaluate itself, or 'load' indicating the model needs
+                                 to be loaded in
+        args (dict)            : customizable method arguments passed in as a dictionary
 
     Returns:
         None
@@ -165,6 +434,7 @@ def score_eval(model: tp.Union[en.RandomForestRegressor, str], args: dict = {})
         'colors'      : [],
         'save'        : False,
         'save_model'  : False,
+        'runtime'     : 'sklearn',
         'dpi'         : 300
     }
 
@@ -179,51 +449,49 @@ def score_eval(model: tp.Union[en.RandomForestRegressor, str], args: dict = {})
         # try default load_name
         _args['load_name'] = default_savename
 
-    curr_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
-
     if isinstance(model, str):
         if model != 'load':
             raise ValueError('unknown command: %s' % model)
         
-        loaded_model = load_model(curr_dir, _args['load_name'])
-    elif isinstance(model, en.RandomForestRegressor):
+        loaded_model = load_model(_CURR_DIR, _args['load_name'])
+    elif isinstance(model, _MODEL_TYPES):
         loaded_model = model
     else:
         raise ValueError('unknown model type: %s' % type(model))
 
-    target_file = os.path.join(curr_dir, _args['data_dir'], 'valid', _args['filename'])
+    target_file = os.path.join(_CURR_DIR, _args['data_dir'], 'valid', _args['filename'])
 
     if not os.path.exists(target_file):
         raise FileNotFoundError('The file specified does not exist')
     
-    df = pd.read_csv(target_file)
+    df = _load_frame(target_file)
 
     # pre-processing
     df = remove_outliers(df, _args)
 
     # split parameters from truth values
-    y1 = pd.DataFrame(df.pop('feh'))
+    y1 = df.pop('feh').to_numpy(dtype=np.float64, copy=False)
     x = df
+    x_arr = np.ascontiguousarray(x[COLORS].to_numpy(dtype=np.float32, copy=False))
 
-    y2 = loaded_model.predict(x)
-    y1 = np.array(y1.values.ravel())
+    y2 = _predict(_CURR_DIR, loaded_model, x_arr, _args['runtime'])
 
     if _args['show']:
         truth_pred_side(x, y1, y2, _args)
         truth_pred_scat(y1, y2, _args)
 
-    print('Score: %.6f' % loaded_model.score(x, y1))
+    print('Score: %.6f' % mt.r2_score(y1, y2))
 
 
 # the function to use the model
-def model_predict(x: pd.DataFrame, model: tp.Union[en.RandomForestRegressor, str], args: dict = {}) -> pd.DataFrame:
+def model_predict(x: pd.DataFrame, model: tp.Union[Regressor, str], args: dict = {}) -> pd.DataFrame:
     '''
     Approximate metallicity values using photometric data as input
     
     Args:
-        x (pd.DataFrame)                      : the input dataframe containing 4 photometric color channel magnitudes
-        model (en.RandomForestRegressor | str): either the model itself, or the command to load the model
-        args (dict)                           : customizable method arguments passed in as a dictionary
+        x (pd.DataFrame)       : the input dataframe containing 4 photometric color channel magnitudes
+        model (Regressor | str): either the model itself, or the command to load the model
+        args (dict)            : customizable method arguments passed in as a dictionary
     
     Returns:
         pandas.DataFrame: corresponding metallicity value for each data point as approximated by model
@@ -231,14 +499,13 @@ def model_predict(x: pd.DataFrame, model: tp.Union[en.RandomForestRegressor, str
 
     _args = {
         'load_name': '',
-        'inplace'  : False
+        'inplace'  : False,
+        'runtime'  : 'sklearn'
     }
 
     for key in args.keys():
         _args[key] = args[key]
 
-    curr_dir = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
-
     if _args['load_name'] == '':
         # try default load_name
         _args['load_name'] = default_savename
@@ -247,17 +514,17 @@ def model_predict(x: pd.DataFrame, model: tp.Union[en.RandomForestRegressor, str
         if model != 'load':
             raise ValueError('unknown command: %s' % model)
         
-        loaded_model = load_model(curr_dir, _args['load_name'])
-    elif isinstance(model, en.RandomForestRegressor):
+        loaded_model = load_model(_CURR_DIR, _args['load_name'])
+    elif isinstance(model, _MODEL_TYPES):
         loaded_model = model
     else:
         raise ValueError('unknown model type: %s' % type(model))
 
-    y = loaded_model.predict(x)
+    y = _predict(_CURR_DIR, loaded_model, np.ascontiguousarray(x[COLORS].to_numpy(dtype=np.float32)), _args['runtime'])
     if _args['inplace']:
         new_df = x
     else:
-        new_df = deepcopy(x)
+        new_df = x.copy(deep=False)     # shares the column data -> adding 'feh' leaves x untouched
     
     new_df['feh'] = y
 
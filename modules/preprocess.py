@@ -18,12 +18,123 @@
 '''
 
 # imports
+import typing as tp
 import pandas as pd
 import numpy as np
 
 # custom library imports
 from visualize import boxplot
 
+COLORS = ['ug', 'gr', 'ri', 'iz']   # expected colors in the input dataframe
+_COMPILED_MIN_ROWS = 1_000_000      # smaller matrices -> numpy is faster than loading numba
+_KERNEL = None                      # compiled mask kernel, loaded on first use (False if numba is missing)
+
+
+# compiled mask kernel -> numba is only imported the first time a large matrix is masked
+def _compiled_kernel() -> tp.Optional[tp.Callable]:
+    '''
+    Loads the numba implementation of outlier_mask once per process
+
+    Returns:
+        callable or None: compiled kernel, None if numba is not installed
+    '''
+
+    global _KERNEL
+    if _KERNEL is None:
+        try:
+            from _preprocess_numba import outlier_mask as kernel
+        except ImportError:
+            kernel = False
+        _KERNEL = kernel
+
+    return _KERNEL or None
+
+
+# rows of a matrix that lie inside the outlier thresholds
+def outlier_mask(M: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    '''
+    Finds the rows of a matrix whose values all lie inside [lo, hi]. Matrices with at least
+    _COMPILED_MIN_ROWS rows use the parallel numba kernel when numba is installed
+
+    Args:
+        M (numpy.ndarray): 2D color matrix with one column per color
+        lo (float)       : lower threshold
+        hi (float)       : upper threshold
+
+    Returns:
+        numpy.ndarray: boolean mask of the rows to keep
+    '''
+
+    if M.shape[0] >= _COMPILED_MIN_ROWS:
+        kernel = _compiled_kernel()
+        if kernel is not None:
+            return kernel(M, lo, hi)
+
+    return ((M >= lo) & (M <= hi)).all(axis=1)
+
+
+# quartile based outlier thresholds for every column of a matrix
+def _iqr_bounds(M: np.ndarray, f: float) -> tp.Tuple[np.ndarray, np.ndarray]:
+    '''
+    Computes the (Q1 - f * IQR, Q3 + f * IQR) thresholds of each column. The quartiles are found by
+    partial sorting (quickselect) and match the linear interpolation of numpy.percentile
+
+    Args:
+        M (numpy.ndarray): 2D input matrix with one column per variable
+        f (float)        : scaling factor for the inter-quartile range
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): lower and upper thresholds for each column
+    '''
+
+    n = M.shape[0]
+    pos = np.array([0.25, 0.75]) * (n - 1)          # fractional ranks of Q1 and Q3
+    lower = pos.astype(int)
+    upper = np.minimum(lower + 1, n - 1)
+
+    a = np.partition(M, np.unique(np.concatenate((lower, upper))), axis=0)
+    q1, q3 = a[lower] + (pos - lower)[:, None] * (a[upper] - a[lower])
+    IQR = q3 - q1
+
+    return q1 - f * IQR, q3 + f * IQR
+
+
+# outlier thresholds after all repetitions of the median reductions
+def outlier_bounds(M: np.ndarray, iqr_factor: float = 1.5, num_reps: int = 1) -> tp.Tuple[float, float]:
+    '''
+    Computes the thresholds that retain the same rows as num_reps repetitions of the outlier exclusion.
+    Every repetition only keeps rows inside its own thresholds, so the combined thresholds are the
+    tightest ones found. Can also be used on a random sample of a dataset that does not fit in memory
+
+    Args:
+        M (numpy.ndarray) : 2D color matrix with one column per color
+        iqr_factor (float): only (-iqr_factor * IQR + Q1, iqr_factor * IQR + Q3) retained
+        num_reps (int)    : number of times to repeat the outlier exclusion
+
+    Returns:
+        (float, float): lower and upper thresholds shared by all colors
+    '''
+
+    if M.shape[0] == 0:
+        raise ValueError('Outlier thresholds cannot be computed for an empty dataset')
+
+    M = np.ascontiguousarray(M)         # row-major -> the mask kernel reads every row in one sweep
+    min_est = -np.inf
+    max_est = np.inf
+
+    # repeat eliminations
+    while num_reps:
+        mins, maxs = _iqr_bounds(M, iqr_factor)
+        min_est = max(min_est, float(mins.min()))       # python floats -> one compiled mask kernel
+        max_est = min(max_est, float(maxs.max()))
+
+        # throw away outliers
+        M = M[outlier_mask(M, min_est, max_est)]
+
+        num_reps -= 1
+
+    return min_est, max_est
+
 
 # preprocess color data to remove extreme outliers through repetitive median reductions
 def remove_outliers(df: pd.DataFrame, args: dict = {} ) -> pd.DataFrame:
@@ -50,39 +161,19 @@ def remove_outliers(df: pd.DataFrame, args: dict = {} ) -> pd.DataFrame:
     for key in args.keys():
         _args[key] = args[key]      # update parameters
 
-    COLORS = ['ug', 'gr', 'ri', 'iz']   # expected colors in the input dataframe
+    if not set(COLORS).issubset(df.columns):
+        raise KeyError('The input dataframe is missing the following columns: %s'
+                       % [x for x in COLORS if x not in df.columns])
 
-    try:
-        color_data = [df[x] for x in COLORS]
-    except KeyError:
-        print('The input dataframe is missing the one of the following columns:')
-        print([x for x in COLORS])
-
-    # repeat eliminations
-    while _args['num_reps']:
-        mins = list()
-        maxs = list()
+    M = np.ascontiguousarray(df[COLORS].to_numpy())     # row-major color matrix -> one column per color
 
-        for elem in COLORS:
-            q3 = np.percentile(df[elem], 75)
-            q1 = np.percentile(df[elem], 25)
-            IQR = q3 - q1
-
-            mins.append(q1 - _args['iqr_factor'] * IQR)
-            maxs.append(q3 + _args['iqr_factor'] * IQR)
-        
-        min_est = min(mins)
-        max_est = max(maxs)
-
-        # throw away outliers
-        for elem in COLORS:
-            df = df[(df[elem] >= min_est) & (df[elem] <= max_est)]
-
-        _args['num_reps'] -= 1
-
-    processed_data = [df[x] for x in COLORS]
+    # throw away outliers
+    min_est, max_est = outlier_bounds(M, _args['iqr_factor'], _args['num_reps'])
+    processed_df = df.iloc[outlier_mask(M, float(min_est), float(max_est))]
 
     if _args['show']:
+        color_data = [df[x] for x in COLORS]
+        processed_data = [processed_df[x] for x in COLORS]
         boxplot(color_data, processed_data, _args)
 
-    return df
+    return processed_df
@@ -23,11 +23,34 @@ import os
 
 # third-party imports
 import matplotlib.pyplot as plt
-import scipy.stats as sts
+from scipy.ndimage import gaussian_filter
+import typing as tp
 import pandas as pd
 import numpy as np
 
 COLORS = ['ug', 'gr', 'ri', 'iz']   # expected colors in the input dataframe
+_CURR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))      # project root directory
+
+
+# random subset of points to draw in scatter plots
+def _sample_index(n: int, cap: int) -> tp.Union[slice, np.ndarray]:
+    '''
+    Selects at most cap of n points (reproducibly) so that scatter plots of large datasets stay fast
+    to render while showing the same distribution
+
+    Args:
+        n (int)  : number of points available
+        cap (int): maximum number of points to draw
+
+    Returns:
+        slice | numpy.ndarray: indexer for the selected points
+    '''
+
+    if n <= cap:
+        return slice(None)
+
+    return np.sort(np.random.default_rng(0).choice(n, cap, replace=False))
+
 
 # produce a before-after comparison box-and-whisker plot for the preprocessing
 def boxplot(before_df: pd.DataFrame, after_df: pd.DataFrame, args: dict) -> None:
@@ -69,11 +92,9 @@ def boxplot(before_df: pd.DataFrame, after_df: pd.DataFrame, args: dict) -> None
 
     if _args['save']:
         # join path to target directory
-        curr_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        dir_path = os.path.join(curr_dir, 'figures')                # directory for figures
+        dir_path = os.path.join(_CURR_DIR, 'figures')               # directory for figures
         
-        if not os.path.exists(dir_path):                            # check to see if directory already exists
-            os.mkdir(dir_path)
+        os.makedirs(dir_path, exist_ok=True)                        # create the directory if it does not exist yet
         
         target_path = os.path.join(dir_path, 'boxplot.png')
         plt.savefig(target_path, dpi=_args['dpi'])
@@ -100,14 +121,20 @@ def truth_pred_side(x: list, y1: list, y2: list, args: dict = {}) -> None:
     '''
 
     _args = {
-        'colors' : [],              # colors for each group
-        'save'   : False,           # save the figure
-        'dpi'    : 300              # save quality
+        'colors'     : [],          # colors for each group
+        'save'       : False,       # save the figure
+        'dpi'        : 300,         # save quality
+        'sample_cap' : 10000        # maximum number of points drawn per scatter plot
     }
 
     for key in args.keys():
         _args[key] = args[key]      # update parameters
 
+    sel = _sample_index(len(y1), _args['sample_cap'])
+    x = x.iloc[sel]
+    y1 = np.asarray(y1)[sel]
+    y2 = np.asarray(y2)[sel]
+
     if len(_args['colors']) < 2:
         # use default colors
         _args['colors'] += ['firebrick', 'skyblue']
@@ -115,20 +142,17 @@ def truth_pred_side(x: list, y1: list, y2: list, args: dict = {}) -> None:
     fig, axs = plt.subplots(4, 2, sharex='row')
     plt.tight_layout()
 
+    x_arrs = [x[col].to_numpy() for col in COLORS]                  # extract each color column once
+    panels = [(y1, _args['colors'][0], 'True'), (y2, _args['colors'][1], 'Predicted')]
+
     for i in range(len(COLORS)):
         col = COLORS[i]
         label = '%s-%s' % (col[0], col[1])
 
-        for j in range(2):
-            if j % 2 == 0:
-                axs[i, j].scatter(x[col], y1, color=_args['colors'][0], marker='.')
-                axs[i, j].set_title('True $%s$' % label.upper())
-                axs[i, j].legend(['True Value'])
-            else:
-                axs[i, j].scatter(x[col], y2, color=_args['colors'][1], marker='.')
-                axs[i, j].set_title('Predicted $%s$' % label.upper())
-                axs[i, j].legend(['Predicted Value'])
-
+        for j, (y, color, kind) in enumerate(panels):
+            axs[i, j].scatter(x_arrs[i], y, color=color, marker='.')
+            axs[i, j].set_title('%s $%s$' % (kind, label.upper()))
+            axs[i, j].legend(['%s Value' % kind])
             axs[i, j].set_xlabel('$%s$' % label)
             axs[i, j].set_ylabel('Metallicity $[Fe/H]$')
 
@@ -137,11 +161,9 @@ def truth_pred_side(x: list, y1: list, y2: list, args: dict = {}) -> None:
 
     if _args['save']:
         # join path to target directory
-        curr_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        dir_path = os.path.join(curr_dir, 'figures')                # directory for figures
+        dir_path = os.path.join(_CURR_DIR, 'figures')               # directory for figures
         
-        if not os.path.exists(dir_path):                            # check to see if directory already exists
-            os.mkdir(dir_path)
+        os.makedirs(dir_path, exist_ok=True)                        # create the directory if it does not exist yet
         
         target_path = os.path.join(dir_path, 'comp_side.png')
         plt.savefig(target_path, dpi=_args['dpi'])
@@ -167,15 +189,26 @@ def truth_pred_scat(y1: list, y2: list, args: dict = {}) -> None:
     '''
 
     _args = {
-        'save': False,          # save the figure
-        'dpi' : 300             # save quality
+        'save'      : False,    # save the figure
+        'dpi'       : 300,      # save quality
+        'kde_bins'  : 256,      # grid size (per axis) of the density estimate
+        'kde_sigma' : 4,        # gaussian smoothing width in grid cells
+        'sample_cap': 10000     # maximum number of points drawn (density uses all points)
     }
 
     for key in args.keys():
         _args[key] = args[key]  # update parameters
 
-    tp = np.vstack((y1, y2))
-    z = sts.gaussian_kde(tp)(tp)
+    # binned density estimate -> histogram smoothed with a gaussian kernel, looked up at each point
+    bins = _args['kde_bins']
+    H, xe, ye = np.histogram2d(y1, y2, bins=bins, density=True)
+    H = gaussian_filter(H, sigma=_args['kde_sigma'])
+    z = H[np.clip(np.searchsorted(xe, y1) - 1, 0, bins - 1), np.clip(np.searchsorted(ye, y2) - 1, 0, bins - 1)]
+
+    sel = _sample_index(len(y1), _args['sample_cap'])
+    y1 = np.asarray(y1)[sel]
+    y2 = np.asarray(y2)[sel]
+    z = z[sel]
 
     plt.scatter(y1, y2, c=z, marker='.')
     plt.plot(y1, y1, 'r-', label='One-to-one Regression Line')
@@ -189,11 +222,9 @@ def truth_pred_scat(y1: list, y2: list, args: dict = {}) -> None:
 
     if _args['save']:
         # join path to target directory
-        curr_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-        dir_path = os.path.join(curr_dir, 'figures')                # directory for figures
+        dir_path = os.path.join(_CURR_DIR, 'figures')               # directory for figures
         
-        if not os.path.exists(dir_path):                            # check to see if directory already exists
-            os.mkdir(dir_path)
+        os.makedirs(dir_path, exist_ok=True)                        # create the directory if it does not exist yet
         
         target_path = os.path.join(dir_path, 'scat.png')
         plt.savefig(target_path, dpi=_args['dpi'])